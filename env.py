@@ -9,8 +9,36 @@ COIN_API_KEY = os.environ.get("COIN_API_KEY")
 ADMIN_CHAT_ID = os.environ.get("ADMIN_CHAT_ID")
 DEBUG = False if os.environ.get("DEBUG", False) == "False" else True
 MAX_BLOCKS_PER_RUN = int(os.environ.get("MAX_BLOCKS_PER_RUN", 100))
+CATCH_UP_BATCH_SIZE = int(os.environ.get("CATCH_UP_BATCH_SIZE", 10_000))
+TAIL_BATCH_SIZE = int(os.environ.get("TAIL_BATCH_SIZE", 1_000))
+TAIL_SLEEP_SECONDS = float(os.environ.get("TAIL_SLEEP_SECONDS", 1))
+# Leave catch-up mode only once the lag is down to this many blocks.
+CATCH_UP_EXIT_BLOCKS = int(
+    os.environ.get("CATCH_UP_EXIT_BLOCKS", MAX_BLOCKS_PER_RUN // 4)
+)
+ERROR_BACKOFF_SECONDS = float(os.environ.get("ERROR_BACKOFF_SECONDS", 1))
+ERROR_BACKOFF_MAX_SECONDS = float(os.environ.get("ERROR_BACKOFF_MAX_SECONDS", 60))
+TOKENS_TAGS_REFRESH_SECONDS = int(os.environ.get("TOKENS_TAGS_REFRESH_SECONDS", 60))
+# Separate connection string for the logged events reads. Unset, they
+# share the pool of the main MongoDB client.
+MONGO_EVENTS_URI = os.environ.get("MONGO_EVENTS_URI")
+MONGO_EVENTS_POOL_SIZE = int(os.environ.get("MONGO_EVENTS_POOL_SIZE", 10))
+MONGO_EVENTS_MAX_STALENESS_SECONDS = int(
+    os.environ.get("MONGO_EVENTS_MAX_STALENESS_SECONDS", 90)
+)
+# "majority" or a number of nodes, per batch type.
+WRITE_CONCERN_LINKS = os.environ.get("WRITE_CONCERN_LINKS", "1")
+WRITE_CONCERN_TOKEN_ADDRESSES = os.environ.get("WRITE_CONCERN_TOKEN_ADDRESSES", "1")
+WRITE_CONCERN_CHECKPOINTS = os.environ.get("WRITE_CONCERN_CHECKPOINTS", "majority")
+# Group fetch requests for urls of the form <prefix><token_id> into one
+# templated request when at least this many share a prefix, 0 disables.
+METADATA_TEMPLATE_MIN_GROUP_SIZE = int(
+    os.environ.get("METADATA_TEMPLATE_MIN_GROUP_SIZE", 0)
+)
 RUN_ON_NET = os.environ.get("RUN_ON_NET")
+# RUN_ON_NET can also be a comma separated list, e.g. "mainnet,testnet".
+RUN_ON_NETS = [net.strip() for net in (RUN_ON_NET or "").split(",") if net.strip()]
 MQTT_USER = os.environ.get("MQTT_USER")
 MQTT_PASSWORD = os.environ.get("MQTT_PASSWORD")
 MQTT_SERVER = os.environ.get("MQTT_SERVER")
-MQTT_QOS = int(os.environ.get("MQTT_QOS"))
+MQTT_QOS = int(os.environ.get("MQTT_QOS", 0))
@@ -1,53 +1,56 @@
+from __future__ import annotations
+
 import datetime as dt
+from typing import TYPE_CHECKING
 
-import aiohttp
 import urllib3
-from ccdexplorer_fundamentals.GRPCClient import GRPCClient
-from ccdexplorer_fundamentals.GRPCClient.CCD_Types import CCD_BlockInfo, CCD_ModuleRef
-from ccdexplorer_fundamentals.mongodb import (
-    Collections,
-    MongoDB,
-    MongoMotor,
-)
-from ccdexplorer_fundamentals.tooter import Tooter
+from ccdexplorer_fundamentals.mongodb import Collections
 from pymongo.collection import Collection
 from rich.console import Console
-import paho.mqtt.client as mqtt
-from env import COIN_API_KEY
+from env import TAIL_BATCH_SIZE
+
+from .idempotency import AppliedEventIndex
+from .metadata import MetadataFingerprintIndex
 
 # from .token_accounting import TokenAccounting as _token_accounting
+from .priority import PriorityLanes as _priority_lanes
+from .scheduling import AdaptiveScheduling as _adaptive_scheduling
+from .services import Services
 from .token_accounting_v2 import TokenAccountingV2 as _token_accounting_v2
-from .utils import Queue
+from .utils import Queue, SchedulingMode
+
+if TYPE_CHECKING:
+    import aiohttp
+    import paho.mqtt.client as paho_mqtt
+    from ccdexplorer_fundamentals.GRPCClient import GRPCClient
+    from ccdexplorer_fundamentals.GRPCClient.CCD_Types import (
+        CCD_BlockInfo,
+        CCD_ModuleRef,
+    )
+    from ccdexplorer_fundamentals.mongodb import MongoDB, MongoMotor
+    from ccdexplorer_fundamentals.tooter import Tooter
 
 urllib3.disable_warnings()
 console = Console()
 
 
-class Heartbeat(_token_accounting_v2):
+class Heartbeat(_token_accounting_v2, _adaptive_scheduling, _priority_lanes):
     def __init__(
         self,
-        grpcclient: GRPCClient,
-        tooter: Tooter,
-        mongodb: MongoDB,
-        motormongo: MongoMotor,
-        mqtt: mqtt.Client,
+        services: Services,
         net: str,
     ):
-        self.grpcclient = grpcclient
-        self.tooter = tooter
-        self.mongodb = mongodb
-        self.motormongo = motormongo
+        self.services = services
         self.net = net
-        self.mqtt = mqtt
         self.address_to_follow = None
         self.sending = False
-        self.utilities: dict[Collections, Collection] = self.mongodb.utilities
-        self.db: dict[Collections, Collection] = (
-            self.mongodb.mainnet if self.net == "mainnet" else self.mongodb.testnet
-        )
-        self.motordb: dict[Collections, Collection] = (
-            self.motormongo.testnet if net == "testnet" else self.motormongo.mainnet
-        )
+        self.mode = SchedulingMode.tail
+        self.batch_size = TAIL_BATCH_SIZE
+        self.lag = 0
+        self.applied_events = AppliedEventIndex()
+        self.priority_contracts: set[str] = set()
+        self.priority_contracts_refreshed_at: dt.datetime | None = None
+        self.metadata_fingerprints = MetadataFingerprintIndex()
         self.finalized_block_infos_to_process: list[CCD_BlockInfo] = []
         self.special_purpose_block_infos_to_process: list[CCD_BlockInfo] = []
 
@@ -61,12 +64,48 @@ class Heartbeat(_token_accounting_v2):
         # If so, we restart, as there's probably something wrong that a restart
         # can fix.
         self.internal_freqency_timer = dt.datetime.now().astimezone(tz=dt.timezone.utc)
-        self.session = aiohttp.ClientSession()
-        coin_api_headers = {
-            "X-CoinAPI-Key": COIN_API_KEY,
-        }
-        self.coin_api_session = aiohttp.ClientSession(headers=coin_api_headers)
-
-    def exit(self):
-        self.session.close()
-        self.coin_api_session.close()
+
+    # Dependencies are only created when first used, see Services.
+    @property
+    def grpcclient(self) -> GRPCClient:
+        return self.services.grpcclient
+
+    @property
+    def tooter(self) -> Tooter:
+        return self.services.tooter
+
+    @property
+    def mongodb(self) -> MongoDB:
+        return self.services.mongodb
+
+    @property
+    def motormongo(self) -> MongoMotor:
+        return self.services.motormongo
+
+    @property
+    def mqtt(self) -> paho_mqtt.Client:
+        return self.services.mqtt
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self.services.session
+
+    @property
+    def coin_api_session(self) -> aiohttp.ClientSession:
+        return self.services.coin_api_session
+
+    @property
+    def utilities(self) -> dict[Collections, Collection]:
+        return self.mongodb.utilities
+
+    @property
+    def db(self) -> dict[Collections, Collection]:
+        return self.mongodb.mainnet if self.net == "mainnet" else self.mongodb.testnet
+
+    @property
+    def motordb(self) -> dict[Collections, Collection]:
+        return (
+            self.motormongo.testnet
+            if self.net == "testnet"
+            else self.motormongo.mainnet
+        )
@@ -0,0 +1,92 @@
+from ccdexplorer_fundamentals.cis import MongoTypeLoggedEventV2
+from rich.console import Console
+
+console = Console()
+
+
+class BalanceBatchResult:
+    """
+    Outcome of applying a batch of logged events to a set of balances.
+    `token_holders` and `token_amounts` contain every token address that
+    was touched, `negative_balances` lists (token_address, account_address)
+    pairs whose balance dipped below zero at any point during the batch.
+    """
+
+    def __init__(self):
+        self.token_holders: dict[str, dict[str, int]] = {}
+        self.token_amounts: dict[str, int] = {}
+        self.negative_balances: list[tuple[str, str]] = []
+
+
+def balance_rows_from_logged_events(
+    logs: list[MongoTypeLoggedEventV2],
+) -> tuple[list[tuple[str, str, int]], list[tuple[str, int]]]:
+    """
+    Turn logged events into signed balance deltas, in the exact order the
+    sequential engine (`execute_logged_event`) would apply them.
+    Returns (holder_rows, supply_rows) with holder_rows as
+    (token_address, account_address, signed_delta) and supply_rows as
+    (token_address, signed_delta).
+    """
+    holder_rows: list[tuple[str, str, int]] = []
+    supply_rows: list[tuple[str, int]] = []
+    for log in logs:
+        event = log.recognized_event
+        token_address = log.event_info.token_address
+        if event.tag == 255:
+            if event.to_address:
+                holder_rows.append(
+                    (token_address, event.to_address, event.token_amount)
+                )
+            if event.from_address:
+                holder_rows.append(
+                    (token_address, event.from_address, -event.token_amount)
+                )
+        elif event.tag == 254:
+            if event.to_address:
+                holder_rows.append(
+                    (token_address, event.to_address, event.token_amount)
+                )
+            supply_rows.append((token_address, event.token_amount))
+        elif event.tag == 253:
+            if event.from_address:
+                holder_rows.append(
+                    (token_address, event.from_address, -event.token_amount)
+                )
+            supply_rows.append((token_address, -event.token_amount))
+    return holder_rows, supply_rows
+
+
+def compute_balances(
+    holder_rows: list[tuple[str, str, int]],
+    supply_rows: list[tuple[str, int]],
+    initial_holders: dict[str, dict[str, int]],
+    initial_amounts: dict[str, int],
+) -> BalanceBatchResult:
+    """
+    Apply signed deltas to the initial balances and supplies.
+    The result is identical to applying the events one by one, but
+    balances stay Python ints for the whole batch, instead of being
+    converted from and to strings for every event.
+    """
+    result = BalanceBatchResult()
+    for token_address, delta in supply_rows:
+        result.token_amounts[token_address] = (
+            result.token_amounts.get(
+                token_address, initial_amounts.get(token_address, 0)
+            )
+            + delta
+        )
+
+    negative = set()
+    for token_address, account_address, delta in holder_rows:
+        holders = result.token_holders.get(token_address)
+        if holders is None:
+            holders = dict(initial_holders.get(token_address, {}))
+            result.token_holders[token_address] = holders
+        balance = holders.get(account_address, 0) + delta
+        holders[account_address] = balance
+        if balance < 0 and (token_address, account_address) not in negative:
+            negative.add((token_address, account_address))
+            result.negative_balances.append((token_address, account_address))
+    return result
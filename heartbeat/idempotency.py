@@ -0,0 +1,93 @@
+from collections import OrderedDict
+
+from ccdexplorer_fundamentals.cis import MongoTypeLoggedEventV2
+
+# (block_height, tx_index, effect_index, event_index)
+EventKey = tuple[int, int, int, int]
+
+APPLIED_EVENT_INDEX_SIZE = 250_000
+
+
+def event_key(log: MongoTypeLoggedEventV2) -> EventKey:
+    return (
+        log.tx_info.block_height,
+        log.tx_info.tx_index,
+        log.event_info.effect_index,
+        log.event_info.event_index,
+    )
+
+
+def checkpoint_cursor(height: int, last_event_key: list | None) -> EventKey:
+    """
+    A checkpoint is the last block whose logged events were all applied,
+    plus the key of the last event read from the next block, if a batch
+    ended inside that block. Returns the key to continue reading after.
+    """
+    if last_event_key is not None and last_event_key[0] == height + 1:
+        return tuple(last_event_key)
+    return (height + 1, -1, -1, -1)
+
+
+def after_event_key_match(key: EventKey) -> dict:
+    """
+    MongoDB filter for logged events with an event key larger than `key`.
+    """
+    height, tx_index, effect_index, event_index = key
+    if tx_index == -1:
+        return {"tx_info.block_height": {"$gte": height}}
+    return {
+        "$or": [
+            {"tx_info.block_height": {"$gt": height}},
+            {"tx_info.block_height": height, "tx_info.tx_index": {"$gt": tx_index}},
+            {
+                "tx_info.block_height": height,
+                "tx_info.tx_index": tx_index,
+                "event_info.effect_index": {"$gt": effect_index},
+            },
+            {
+                "tx_info.block_height": height,
+                "tx_info.tx_index": tx_index,
+                "event_info.effect_index": effect_index,
+                "event_info.event_index": {"$gt": event_index},
+            },
+        ]
+    }
+
+
+class AppliedEventIndex:
+    """
+    Keeps the key of the last applied logged event per token address id.
+    Events for a token address are applied in key order, so an event is a
+    duplicate if its key is not larger than the last applied key. This is
+    the in-memory front, the keys are persisted as `last_event_key` on the
+    token address documents and loaded back when they are read.
+    """
+
+    def __init__(self, max_size: int = APPLIED_EVENT_INDEX_SIZE):
+        self.max_size = max_size
+        self.last_applied: OrderedDict[int, EventKey] = OrderedDict()
+
+    def get(self, token_address_id: int) -> EventKey | None:
+        return self.last_applied.get(token_address_id)
+
+    def load(self, token_address_id: int, key: list | None):
+        """
+        Merge a persisted key. The in-memory key is never moved backwards,
+        as it may be ahead of what is stored.
+        """
+        if key is None:
+            return
+        key = tuple(key)
+        current = self.last_applied.get(token_address_id)
+        if current is None or key > current:
+            self.update(token_address_id, key)
+
+    def update(self, token_address_id: int, key: EventKey):
+        self.last_applied[token_address_id] = key
+        self.last_applied.move_to_end(token_address_id)
+        if len(self.last_applied) > self.max_size:
+            self.last_applied.popitem(last=False)
+
+    def is_applied(self, token_address_id: int, key: EventKey) -> bool:
+        current = self.last_applied.get(token_address_id)
+        return current is not None and key <= current
@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+# Per-process bounds. A batch holds far fewer distinct values than this,
+# so ids handed out during a batch are never evicted while in use.
+INTERN_TABLE_SIZE = 1_000_000
+DERIVED_CACHE_SIZE = 250_000
+
+
+class InternTable:
+    """
+    Maps strings (account addresses, contracts, token addresses) to small
+    integer ids. Least recently used entries are evicted once the table
+    is full. Ids are never reused, so an id always refers to one string.
+    The table is shared by the accounting cycles of all nets, which run
+    in worker threads, so `intern` holds a lock.
+    """
+
+    def __init__(self, max_size: int = INTERN_TABLE_SIZE):
+        self.max_size = max_size
+        self.ids: OrderedDict[str, int] = OrderedDict()
+        self.values: dict[int, str] = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def intern(self, value: str) -> int:
+        with self.lock:
+            _id = self.ids.get(value)
+            if _id is not None:
+                self.ids.move_to_end(value)
+                return _id
+
+            _id = self.next_id
+            self.next_id += 1
+            self.ids[value] = _id
+            self.values[_id] = value
+            if len(self.ids) > self.max_size:
+                _, evicted_id = self.ids.popitem(last=False)
+                del self.values[evicted_id]
+            return _id
+
+    def lookup(self, _id: int) -> str:
+        return self.values[_id]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+interned = InternTable()
+
+
+@lru_cache(maxsize=DERIVED_CACHE_SIZE)
+def split_token_address(token_address: str) -> tuple[str, str]:
+    """
+    Returns (contract, token_id) for a token address like '<9341,0>-'.
+    """
+    contract, token_id = token_address.split("-", 1)
+    return contract, token_id
+
+
+@lru_cache(maxsize=DERIVED_CACHE_SIZE)
+def token_address_parts(token_address_id: int) -> tuple[str, str, str]:
+    """
+    Returns (token_address, contract, token_id) for an interned token address.
+    """
+    token_address = interned.lookup(token_address_id)
+    return (token_address, *split_token_address(token_address))
+
+
+@lru_cache(maxsize=DERIVED_CACHE_SIZE)
+def account_address_parts(account_id: int) -> tuple[str, str]:
+    """
+    Returns (account_address, account_address_canonical) for an interned address.
+    """
+    account_address = interned.lookup(account_id)
+    return account_address, account_address[:29]
+
+
+@lru_cache(maxsize=DERIVED_CACHE_SIZE)
+def link_id(token_address_id: int, account_id: int) -> str:
+    """
+    The `_id` of a document in the links collection.
+    """
+    return f"{interned.lookup(token_address_id)}-{interned.lookup(account_id)}"
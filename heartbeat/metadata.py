@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from ccdexplorer_fundamentals.cis import MongoTypeTokenAddress
+from ccdexplorer_fundamentals.mongodb import Collections
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from rich.console import Console
+
+from env import METADATA_TEMPLATE_MIN_GROUP_SIZE, MQTT_QOS
+
+from .interning import interned, split_token_address
+from .routing import WRITE_CONCERNS, BatchType
+
+if TYPE_CHECKING:
+    import paho.mqtt.client as mqtt
+
+console = Console()
+
+METADATA_FINGERPRINT_INDEX_SIZE = 250_000
+
+
+def metadata_url_fingerprint(url: str | None) -> str:
+    return hashlib.blake2b((url or "").encode(), digest_size=8).hexdigest()
+
+
+class MetadataFingerprintIndex:
+    """
+    In-memory front for the metadata url fingerprints per token address id.
+    Fingerprints are persisted in `tokens_metadata_fingerprints`.
+    """
+
+    def __init__(self, max_size: int = METADATA_FINGERPRINT_INDEX_SIZE):
+        self.max_size = max_size
+        self.fingerprints: OrderedDict[int, str] = OrderedDict()
+
+    def get(self, token_address_id: int) -> str | None:
+        return self.fingerprints.get(token_address_id)
+
+    def update(self, token_address_id: int, fingerprint: str):
+        self.fingerprints[token_address_id] = fingerprint
+        self.fingerprints.move_to_end(token_address_id)
+        if len(self.fingerprints) > self.max_size:
+            self.fingerprints.popitem(last=False)
+
+
+class MetadataFetchRequests:
+    """
+    Publishes metadata fetch requests only for new token addresses and for
+    token addresses whose metadata url changed. Urls of the form
+    <prefix><token_id> (for example https://nft.ptags.io/<TOKEN_ID>) can be
+    grouped into one templated request, see METADATA_TEMPLATE_MIN_GROUP_SIZE.
+    """
+
+    def metadata_fingerprints_collection(self) -> Collection:
+        self.db: dict[Collections, Collection]
+        token_addresses = self.db[Collections.tokens_token_addresses_v2]
+        return token_addresses.database["tokens_metadata_fingerprints"]
+
+    def publish_metadata_fetch_requests(
+        self,
+        fetch_requests: dict[int, dict],
+        token_addresses_initial: dict[int, MongoTypeTokenAddress],
+    ):
+        self.mqtt: mqtt.Client
+        if len(fetch_requests) == 0:
+            return
+
+        # Load persisted fingerprints we don't have in memory.
+        missing = [
+            interned.lookup(token_address_id)
+            for token_address_id in fetch_requests
+            if self.metadata_fingerprints.get(token_address_id) is None
+        ]
+        if missing:
+            for x in self.metadata_fingerprints_collection().find(
+                {"_id": {"$in": missing}}
+            ):
+                self.metadata_fingerprints.update(interned.intern(x["_id"]), x["f"])
+
+        changed: dict[int, str] = {}
+        for token_address_id, request in fetch_requests.items():
+            fingerprint = metadata_url_fingerprint(request.get("metadata_url"))
+            is_new = token_address_id not in token_addresses_initial
+            if is_new or (
+                self.metadata_fingerprints.get(token_address_id) != fingerprint
+            ):
+                changed[token_address_id] = fingerprint
+
+        remaining = self.publish_templated_fetch_requests(
+            {x: fetch_requests[x] for x in changed}
+        )
+        for token_address_id in remaining:
+            self.mqtt.publish(
+                f"ccdexplorer/{self.net}/metadata/fetch",
+                json.dumps(fetch_requests[token_address_id]),
+                qos=MQTT_QOS,
+            )
+
+        if len(fetch_requests) > len(changed):
+            console.log(
+                f"Metadata on {self.net}: {len(changed):,.0f} fetch requests, {len(fetch_requests) - len(changed):,.0f} unchanged urls skipped."
+            )
+        if len(changed) == 0:
+            return
+        self.metadata_fingerprints_collection().with_options(
+            write_concern=WRITE_CONCERNS[BatchType.token_addresses]
+        ).bulk_write(
+            [
+                UpdateOne(
+                    {"_id": interned.lookup(token_address_id)},
+                    {"$set": {"f": fingerprint}},
+                    upsert=True,
+                )
+                for token_address_id, fingerprint in changed.items()
+            ],
+            ordered=False,
+        )
+        for token_address_id, fingerprint in changed.items():
+            self.metadata_fingerprints.update(token_address_id, fingerprint)
+
+    def publish_templated_fetch_requests(
+        self, fetch_requests: dict[int, dict]
+    ) -> list[int]:
+        """
+        Groups requests whose url is <prefix><token_id>, per contract, prefix
+        and casing of the token_id. Groups of at least
+        METADATA_TEMPLATE_MIN_GROUP_SIZE are sent as one request to
+        `ccdexplorer/{net}/metadata/fetch/template`. Returns the token
+        address ids that still need an individual request.
+        """
+        if METADATA_TEMPLATE_MIN_GROUP_SIZE < 2:
+            return list(fetch_requests)
+
+        groups: dict[tuple[str, str, str], list[int]] = {}
+        remaining = []
+        for token_address_id, request in fetch_requests.items():
+            url = request.get("metadata_url")
+            contract, token_id = split_token_address(interned.lookup(token_address_id))
+            if not url or not token_id:
+                remaining.append(token_address_id)
+                continue
+            for case, formatted in [
+                ("same", token_id),
+                ("upper", token_id.upper()),
+                ("lower", token_id.lower()),
+            ]:
+                if url.endswith(formatted):
+                    prefix = url[: -len(formatted)]
+                    groups.setdefault((contract, prefix, case), []).append(
+                        token_address_id
+                    )
+                    break
+            else:
+                remaining.append(token_address_id)
+
+        for (contract, prefix, case), token_address_ids in groups.items():
+            if len(token_address_ids) < METADATA_TEMPLATE_MIN_GROUP_SIZE:
+                remaining.extend(token_address_ids)
+                continue
+            self.mqtt.publish(
+                f"ccdexplorer/{self.net}/metadata/fetch/template",
+                json.dumps(
+                    {
+                        "contract": contract,
+                        "url_template": prefix + "{token_id}",
+                        "token_id_case": case,
+                        "token_addresses": [
+                            interned.lookup(x) for x in token_address_ids
+                        ],
+                    }
+                ),
+                qos=MQTT_QOS,
+            )
+        return remaining
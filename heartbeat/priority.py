@@ -0,0 +1,97 @@
+import datetime as dt
+
+from ccdexplorer_fundamentals.mongodb import Collections
+from pymongo.collection import Collection
+from rich.console import Console
+
+from env import TOKENS_TAGS_REFRESH_SECONDS
+
+from .idempotency import EventKey, checkpoint_cursor
+
+console = Console()
+
+
+class PriorityLanes:
+    """
+    During catch-up, tokens in `tokens_tags` (stablecoins and other
+    recognized tokens) would otherwise wait behind bulk NFT mints in the
+    same batch. The priority lane processes events for tagged contracts
+    ahead of the main checkpoint, with its own checkpoint. When the main
+    lane reaches these events, they are skipped as already applied.
+    """
+
+    def refresh_priority_contracts(self):
+        """
+        The tag set is cached and reloaded every TOKENS_TAGS_REFRESH_SECONDS.
+        If contracts were added, the priority checkpoint is moved back to the
+        main checkpoint, so the new contracts are not applied out of order.
+        """
+        self.db: dict[Collections, Collection]
+        now = dt.datetime.now().astimezone(tz=dt.timezone.utc)
+        if (
+            self.priority_contracts_refreshed_at
+            and (now - self.priority_contracts_refreshed_at).total_seconds()
+            < TOKENS_TAGS_REFRESH_SECONDS
+        ):
+            return
+
+        contracts = set()
+        for tag in self.db[Collections.tokens_tags].find({}, {"contracts": 1}):
+            contracts.update(tag.get("contracts", []))
+        self.priority_contracts_refreshed_at = now
+
+        if contracts == self.priority_contracts:
+            return
+        added = contracts - self.priority_contracts
+        console.log(
+            f"Token accounting on {self.net}: priority lane now has {len(contracts):,.0f} contracts ({len(added):,.0f} added)."
+        )
+        self.priority_contracts = contracts
+        if added:
+            self.log_last_priority_token_accounted_message_in_mongo(
+                self.read_last_token_accounted_height()
+            )
+
+    def update_priority_token_accounting_v2(self):
+        self.refresh_priority_contracts()
+        main_checkpoint, main_last_event_key = self.read_token_accounting_checkpoint(
+            "token_accounting_last_processed_block_v3"
+        )
+        if main_checkpoint == -1:
+            # Starting over, the priority lane starts over with it.
+            self.log_last_priority_token_accounted_message_in_mongo(-1)
+            return
+        if len(self.priority_contracts) == 0:
+            return
+
+        # Continue after whichever lane got furthest.
+        cursor = max(
+            checkpoint_cursor(main_checkpoint, main_last_event_key),
+            checkpoint_cursor(
+                *self.read_token_accounting_checkpoint(
+                    "token_accounting_last_processed_block_v3_priority"
+                )
+            ),
+        )
+        result, from_secondary = self.fetch_logged_events_v2(
+            cursor, self.batch_size, sorted(self.priority_contracts)
+        )
+        if len(result) == 0:
+            return
+
+        console.log(
+            f"Token accounting priority lane: Starting at {(cursor[0] - 1):,.0f}, I found {len(result):,.0f} logged events on {self.net} to process."
+        )
+        self.process_logged_events_v2(result)
+        self.log_last_priority_token_accounted_message_in_mongo(
+            *self.checkpoint_after_batch_v2(result, self.batch_size, from_secondary)
+        )
+
+    def log_last_priority_token_accounted_message_in_mongo(
+        self, height: int, last_event_key: EventKey | None = None
+    ):
+        self.log_token_accounting_checkpoint(
+            "token_accounting_last_processed_block_v3_priority",
+            height,
+            last_event_key,
+        )
@@ -0,0 +1,77 @@
+from enum import Enum
+
+from ccdexplorer_fundamentals.mongodb import Collections
+from pymongo.collection import Collection
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Primary, SecondaryPreferred
+from pymongo.write_concern import WriteConcern
+
+from env import (
+    MONGO_EVENTS_MAX_STALENESS_SECONDS,
+    WRITE_CONCERN_CHECKPOINTS,
+    WRITE_CONCERN_LINKS,
+    WRITE_CONCERN_TOKEN_ADDRESSES,
+)
+
+
+class BatchType(Enum):
+    """
+    Type of batch we write, each with its own (configurable) write concern.
+    """
+
+    links = "links"
+    token_addresses = "token_addresses"
+    checkpoints = "checkpoints"
+
+
+def parse_write_concern(value: str) -> WriteConcern:
+    return WriteConcern(w=int(value) if value.isdigit() else value)
+
+
+WRITE_CONCERNS = {
+    BatchType.links: parse_write_concern(WRITE_CONCERN_LINKS),
+    BatchType.token_addresses: parse_write_concern(WRITE_CONCERN_TOKEN_ADDRESSES),
+    BatchType.checkpoints: parse_write_concern(WRITE_CONCERN_CHECKPOINTS),
+}
+
+
+class MongoRouting:
+    """
+    Routes accounting reads and writes:
+    - logged events are read from secondaries (bounded staleness) in
+      catch-up mode, through their own connection pool if MONGO_EVENTS_URI is set,
+    - token addresses, links and checkpoints are read from the primary
+      with read concern local, so we see our own writes as soon as they
+      are acknowledged. Majority reads would miss writes made with w=1
+      until they have replicated, and the next catch-up batch starts
+      right away,
+    - writes use the write concern configured for their batch type.
+    """
+
+    def events_collection(self, from_secondary: bool) -> Collection:
+        self.db: dict[Collections, Collection]
+        collection = self.db[Collections.tokens_logged_events_v2]
+        if not from_secondary:
+            return collection
+
+        events_client = self.services.events_client
+        if events_client is not None:
+            # The events client defaults to secondaryPreferred.
+            return events_client[collection.database.name][collection.name]
+        return collection.with_options(
+            read_preference=SecondaryPreferred(
+                max_staleness=MONGO_EVENTS_MAX_STALENESS_SECONDS
+            )
+        )
+
+    def consistent_collection(self, collection: Collections) -> Collection:
+        return self.db[collection].with_options(
+            read_preference=Primary(), read_concern=ReadConcern("local")
+        )
+
+    def write_collection(
+        self, collection: Collections, batch_type: BatchType
+    ) -> Collection:
+        return self.db[collection].with_options(
+            write_concern=WRITE_CONCERNS[batch_type]
+        )
@@ -0,0 +1,129 @@
+import asyncio
+import datetime as dt
+
+from ccdexplorer_fundamentals.mongodb import Collections
+from pymongo import DESCENDING
+from pymongo.collection import Collection
+from rich.console import Console
+
+from env import (
+    CATCH_UP_BATCH_SIZE,
+    CATCH_UP_EXIT_BLOCKS,
+    ERROR_BACKOFF_MAX_SECONDS,
+    ERROR_BACKOFF_SECONDS,
+    MAX_BLOCKS_PER_RUN,
+    TAIL_BATCH_SIZE,
+    TAIL_SLEEP_SECONDS,
+)
+
+from .token_accounting_v2 import ACCOUNTING_EVENT_TAGS
+from .utils import SchedulingMode
+
+console = Console()
+
+
+class AdaptiveScheduling:
+    """
+    Replaces the fixed one second schedule. Every cycle we compare the
+    token accounting checkpoint with the latest block height in the
+    logged events collection. If we are more than MAX_BLOCKS_PER_RUN
+    blocks behind, we run in catch-up mode (large batches, no sleep,
+    parallel writes) until the lag is down to CATCH_UP_EXIT_BLOCKS,
+    otherwise in tail mode (small batches, short sleep).
+    After a failed cycle we back off, doubling the wait up to
+    ERROR_BACKOFF_MAX_SECONDS, so a persistent error doesn't spin.
+    A cycle only uses blocking pymongo calls, so it runs in a worker
+    thread. That way the loops for other nets in the same process keep
+    running while one of them waits on MongoDB.
+    """
+
+    async def run_token_accounting(self):
+        failures = 0
+        while True:
+            try:
+                await asyncio.to_thread(self.run_token_accounting_cycle)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                backoff = min(
+                    ERROR_BACKOFF_SECONDS * 2 ** (failures - 1),
+                    ERROR_BACKOFF_MAX_SECONDS,
+                )
+                console.log(
+                    f"Token accounting on {self.net} failed ({failures:,.0f} in a row), retrying in {backoff:,.0f}s: {e}"
+                )
+                await asyncio.sleep(backoff)
+                continue
+
+            if self.mode == SchedulingMode.catch_up:
+                # yield to the event loop, but don't wait.
+                await asyncio.sleep(0)
+            else:
+                await asyncio.sleep(TAIL_SLEEP_SECONDS)
+
+    def run_token_accounting_cycle(self):
+        self.update_scheduling_mode()
+        if self.mode == SchedulingMode.catch_up:
+            # tagged tokens first, bulk contracts wait their turn.
+            self.update_priority_token_accounting_v2()
+        self.update_token_accounting_v2()
+
+    def reads_events_from_secondary(self) -> bool:
+        """
+        Only in catch-up mode, where a few seconds of replication lag
+        don't matter. See `checkpoint_after_batch_v2`.
+        """
+        return self.mode == SchedulingMode.catch_up
+
+    def get_latest_logged_event_height(self) -> int:
+        self.db: dict[Collections, Collection]
+        result = self.db[Collections.tokens_logged_events_v2].find_one(
+            {
+                "event_info.standard": "CIS-2",
+                "recognized_event.tag": {"$in": ACCOUNTING_EVENT_TAGS},
+            },
+            projection={"tx_info.block_height": 1},
+            sort=[("tx_info.block_height", DESCENDING)],
+        )
+        if result:
+            return result["tx_info"]["block_height"]
+        else:
+            return -1
+
+    def update_scheduling_mode(self):
+        checkpoint = self.read_last_token_accounted_height()
+        latest = self.get_latest_logged_event_height()
+        self.lag = max(0, latest - checkpoint)
+
+        # Separate enter and exit thresholds, so a lag hovering around
+        # one threshold doesn't flip the mode every cycle.
+        if self.lag > MAX_BLOCKS_PER_RUN:
+            mode = SchedulingMode.catch_up
+        elif self.lag <= CATCH_UP_EXIT_BLOCKS:
+            mode = SchedulingMode.tail
+        else:
+            mode = self.mode
+        if mode == self.mode:
+            return
+
+        console.log(
+            f"Token accounting on {self.net}: switching from {self.mode.value} to {mode.value} mode, lag is {self.lag:,.0f} blocks."
+        )
+        self.mode = mode
+        self.batch_size = (
+            CATCH_UP_BATCH_SIZE if mode == SchedulingMode.catch_up else TAIL_BATCH_SIZE
+        )
+        self.log_scheduling_mode_in_mongo()
+
+    def log_scheduling_mode_in_mongo(self):
+        self.db[Collections.helpers].replace_one(
+            {"_id": "token_accounting_scheduling_mode"},
+            {
+                "_id": "token_accounting_scheduling_mode",
+                "mode": self.mode.value,
+                "lag": self.lag,
+                "batch_size": self.batch_size,
+                "since": dt.datetime.now().astimezone(tz=dt.timezone.utc),
+            },
+            upsert=True,
+        )
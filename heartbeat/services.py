@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+from functools import cached_property
+from typing import TYPE_CHECKING
+
+from rich.console import Console
+
+from env import (
+    COIN_API_KEY,
+    MONGO_EVENTS_MAX_STALENESS_SECONDS,
+    MONGO_EVENTS_POOL_SIZE,
+    MONGO_EVENTS_URI,
+    MQTT_PASSWORD,
+    MQTT_QOS,
+    MQTT_SERVER,
+    MQTT_USER,
+)
+
+if TYPE_CHECKING:
+    import aiohttp
+    import paho.mqtt.client as paho_mqtt
+    from ccdexplorer_fundamentals.GRPCClient import GRPCClient
+    from ccdexplorer_fundamentals.mongodb import MongoDB, MongoMotor
+    from ccdexplorer_fundamentals.tooter import Tooter
+    from pymongo import MongoClient
+
+console = Console()
+
+
+# The callback for when the client receives a CONNACK response from the server.
+def on_connect(client, userdata, flags, reason_code, properties):
+    console.log(f"MQTT connected with result code: {reason_code}")
+    # Subscribing here means we also resubscribe after a reconnect.
+    client.subscribe("ccdexplorer/services/accounting/restart", qos=MQTT_QOS)
+
+
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
+    if reason_code_list[0].is_failure:
+        console.log(f"Broker rejected you subscription: {reason_code_list[0]}")
+    else:
+        console.log(f"Broker granted the following QoS: {reason_code_list[0].value}")
+
+
+class Services:
+    """
+    Container for the external dependencies. Each one is created (and its
+    module imported) on first use only, so startup doesn't wait for
+    connections the accounting loop never needs (gRPC, CoinAPI, HTTP).
+    MQTT connects in its own network thread, without blocking the first
+    accounting cycle.
+    """
+
+    def __init__(self, mqtt_client_id: str):
+        self.mqtt_client_id = mqtt_client_id
+
+    @cached_property
+    def tooter(self) -> Tooter:
+        from ccdexplorer_fundamentals.tooter import Tooter
+
+        return Tooter()
+
+    @cached_property
+    def grpcclient(self) -> GRPCClient:
+        from ccdexplorer_fundamentals.GRPCClient import GRPCClient
+
+        return GRPCClient()
+
+    @cached_property
+    def mongodb(self) -> MongoDB:
+        from ccdexplorer_fundamentals.mongodb import MongoDB
+
+        return MongoDB(self.tooter)
+
+    @cached_property
+    def motormongo(self) -> MongoMotor:
+        from ccdexplorer_fundamentals.mongodb import MongoMotor
+
+        return MongoMotor(self.tooter)
+
+    @cached_property
+    def events_client(self) -> MongoClient | None:
+        """
+        Separate pool for the large logged events reads, so they don't
+        compete with the accounting writes for connections. Only available
+        when MONGO_EVENTS_URI is set. Writes and all other reads use the
+        pool of the main MongoDB client, sized by ccdexplorer_fundamentals.
+        """
+        if not MONGO_EVENTS_URI:
+            return None
+        from pymongo import MongoClient
+
+        return MongoClient(
+            MONGO_EVENTS_URI,
+            maxPoolSize=MONGO_EVENTS_POOL_SIZE,
+            readPreference="secondaryPreferred",
+            maxStalenessSeconds=MONGO_EVENTS_MAX_STALENESS_SECONDS,
+        )
+
+    @cached_property
+    def mqtt(self) -> paho_mqtt.Client:
+        import paho.mqtt.client as paho_mqtt
+
+        mqttc = paho_mqtt.Client(
+            paho_mqtt.CallbackAPIVersion.VERSION2,
+            self.mqtt_client_id,
+        )
+        mqttc.on_connect = on_connect
+        mqttc.on_subscribe = on_subscribe
+        mqttc.username_pw_set(MQTT_USER, MQTT_PASSWORD)
+        mqttc.connect_async(MQTT_SERVER, 1883, 10)
+        mqttc.loop_start()
+        return mqttc
+
+    @cached_property
+    def session(self) -> aiohttp.ClientSession:
+        import aiohttp
+
+        return aiohttp.ClientSession()
+
+    @cached_property
+    def coin_api_session(self) -> aiohttp.ClientSession:
+        import aiohttp
+
+        coin_api_headers = {
+            "X-CoinAPI-Key": COIN_API_KEY,
+        }
+        return aiohttp.ClientSession(headers=coin_api_headers)
+
+    def is_started(self, name: str) -> bool:
+        return name in self.__dict__
+
+    async def close(self):
+        for name in ["session", "coin_api_session"]:
+            if self.is_started(name):
+                await self.__dict__[name].close()
+        if self.is_started("events_client") and self.events_client is not None:
+            self.events_client.close()
+        if self.is_started("mqtt"):
+            self.mqtt.loop_stop()
+            self.mqtt.disconnect()
@@ -25,6 +25,7 @@ from pymongo import ASCENDING, DeleteOne, ReplaceOne
 from pymongo.collection import Collection
 from rich.console import Console
 
+from .balance_engine import balance_rows_from_logged_events, compute_balances
 from .utils import Queue, Utils
 
 console = Console()
@@ -152,16 +153,28 @@ class TokenAccounting(Utils):
                         link_account_address
                     ] = MongoTypeTokenLink(**link)
 
-                for index, token_address in enumerate(
-                    list(events_by_token_address.keys())
-                ):
-                    self.token_accounting_for_token_address(
+                # Prepare all token addresses first, so the whole batch
+                # can be applied in one pass.
+                token_addresses_as_class = {
+                    token_address: self.prepare_token_address_for_accounting(
                         token_address,
-                        events_by_token_address,
                         token_addresses_as_class_from_collection,
                         token_links_from_collection_by_token_address,
                         token_accounting_last_processed_block,
                     )
+                    for token_address in events_by_token_address.keys()
+                }
+                self.execute_logged_events_batch(token_addresses_as_class, result)
+
+                for (
+                    token_address,
+                    token_address_as_class,
+                ) in token_addresses_as_class.items():
+                    self.queue_token_address_for_mongo(
+                        token_address_as_class,
+                        events_by_token_address[token_address][-1],
+                        token_links_from_collection_by_token_address,
+                    )
 
                 self.send_token_queues_to_mongo(0)
                 self.log_last_token_accounted_message_in_mongo(
@@ -208,8 +221,43 @@ class TokenAccounting(Utils):
         token_links_from_collection_by_token_address: dict,
         token_accounting_last_processed_block: int = -1,
     ):
-        self.queues: dict[Collections, list]
-        queue = []
+        """
+        Sequential token accounting for a single token_address. This is the
+        reference implementation for `execute_logged_events_batch`.
+        """
+        token_address_as_class = self.prepare_token_address_for_accounting(
+            token_address,
+            token_addresses_as_class_from_collection,
+            token_links_from_collection_by_token_address,
+            token_accounting_last_processed_block,
+        )
+
+        # This is the list of logged events for the selected token_address
+        logs_for_token_address: MongoTypeLoggedEventV2 = events_by_token_address[
+            token_address
+        ]
+        for log in logs_for_token_address:
+            log: MongoTypeLoggedEventV2
+            # Perform token accounting for this logged event
+            # This function works on and returns 'token_address_as_class'.
+            token_address_as_class = self.execute_logged_event(
+                token_address_as_class,
+                log,
+            )
+
+        self.queue_token_address_for_mongo(
+            token_address_as_class,
+            log,
+            token_links_from_collection_by_token_address,
+        )
+
+    def prepare_token_address_for_accounting(
+        self,
+        token_address: str,
+        token_addresses_as_class_from_collection: dict,
+        token_links_from_collection_by_token_address: dict,
+        token_accounting_last_processed_block: int = -1,
+    ) -> MongoTypeTokenAddress:
         # if we start at the beginning of the chain for token accounting
         # create an empty token address as class to start
         if token_accounting_last_processed_block == -1:
@@ -250,20 +298,15 @@ class TokenAccounting(Utils):
                     }
                 else:
                     token_address_as_class.token_holders = {}
+        return token_address_as_class
 
-        # This is the list of logged events for the selected token_address
-        logs_for_token_address: MongoTypeLoggedEventV2 = events_by_token_address[
-            token_address
-        ]
-        for log in logs_for_token_address:
-            log: MongoTypeLoggedEventV2
-            # Perform token accounting for this logged event
-            # This function works on and returns 'token_address_as_class'.
-            token_address_as_class = self.execute_logged_event(
-                token_address_as_class,
-                log,
-            )
-
+    def queue_token_address_for_mongo(
+        self,
+        token_address_as_class: MongoTypeTokenAddress,
+        log: MongoTypeLoggedEventV2,
+        token_links_from_collection_by_token_address: dict,
+    ):
+        self.queues: dict[Collections, list]
         # Set the last block_height that affected the token accounting
         # for this token_address to the last logged event block_height.
         token_address_as_class.last_height_processed = log.tx_info.block_height
@@ -455,6 +498,59 @@ class TokenAccounting(Utils):
         )
         return token_address
 
+    def execute_logged_events_batch(
+        self,
+        token_addresses_as_class: dict[str, MongoTypeTokenAddress],
+        logs: list[MongoTypeLoggedEventV2],
+    ):
+        """
+        Batch counterpart of calling `execute_logged_event` for every
+        log in order. Mints, burns and transfers are reduced to signed
+        deltas and summed per (token_address, account_address), metadata
+        events are applied in order. The resulting holders and supplies
+        are identical to the sequential engine.
+        """
+        initial_holders = {
+            token_address: {
+                address: int(amount)
+                for address, amount in token_address_as_class.token_holders.items()
+            }
+            for token_address, token_address_as_class in (
+                token_addresses_as_class.items()
+            )
+        }
+        initial_amounts = {
+            token_address: int(token_address_as_class.token_amount)
+            for token_address, token_address_as_class in (
+                token_addresses_as_class.items()
+            )
+        }
+        holder_rows, supply_rows = balance_rows_from_logged_events(logs)
+        result = compute_balances(
+            holder_rows, supply_rows, initial_holders, initial_amounts
+        )
+
+        for token_address, token_holders in result.token_holders.items():
+            token_addresses_as_class[token_address].token_holders = {
+                address: str(amount) for address, amount in token_holders.items()
+            }
+        for token_address, token_amount in result.token_amounts.items():
+            token_addresses_as_class[token_address].token_amount = str(token_amount)
+
+        for log in logs:
+            if log.recognized_event.tag == 251:
+                token_addresses_as_class[log.event_info.token_address] = (
+                    self.save_metadata(
+                        token_addresses_as_class[log.event_info.token_address], log
+                    )
+                )
+
+        for token_address, account_address in result.negative_balances:
+            console.log(
+                f"Token accounting: balance for {account_address} on {token_address} went negative in this batch."
+            )
+        return token_addresses_as_class
+
     def execute_logged_event(
         self,
         token_address_as_class: MongoTypeTokenAddress,
@@ -1,7 +1,9 @@
-import asyncio
-import json
+from __future__ import annotations
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
-import paho.mqtt.client as mqtt
 from ccdexplorer_fundamentals.cis import (
     MongoTypeLoggedEventV2,
     MongoTypeTokenAddress,
@@ -12,20 +14,55 @@ from ccdexplorer_fundamentals.cis import (
 from ccdexplorer_fundamentals.mongodb import (
     Collections,
 )
-from pymongo import ASCENDING, ReplaceOne
+from pymongo import ASCENDING, ReplaceOne, UpdateOne
 from pymongo.collection import Collection
 from rich.console import Console
 
-from env import MQTT_QOS
+from .idempotency import (
+    AppliedEventIndex,
+    EventKey,
+    after_event_key_match,
+    checkpoint_cursor,
+    event_key,
+)
+from .interning import (
+    account_address_parts,
+    interned,
+    link_id,
+    split_token_address,
+    token_address_parts,
+)
+from .metadata import MetadataFetchRequests
+from .routing import BatchType
+from .utils import SchedulingMode, Utils
 
-from .utils import Utils
+if TYPE_CHECKING:
+    import paho.mqtt.client as paho_mqtt
 
 console = Console()
 
 
+# transfer, mint, burn and metadata
+ACCOUNTING_EVENT_TAGS = [255, 254, 253, 251]
+
+
+class TokenAccountingBatchV2:
+    """
+    What a batch of logged events changes. Links are keyed on
+    (token_address id, account id), so repeated touches of the same link
+    within a batch result in one write.
+    """
+
+    def __init__(self, token_addresses_initial: dict[int, MongoTypeTokenAddress]):
+        self.token_addresses_initial = token_addresses_initial
+        self.token_addresses_to_update: dict[int, MongoTypeTokenAddress] = {}
+        self.links_to_update: set[tuple[int, int]] = set()
+        self.last_event_keys: dict[int, EventKey] = {}
+
+
 ########### Token Accounting V3
-class TokenAccountingV2(Utils):
-    async def update_token_accounting_v2(self):
+class TokenAccountingV2(Utils, MetadataFetchRequests):
+    def update_token_accounting_v2(self):
         """
         This method takes logged events and processes them for
         token accounting. Note that token accounting only processes events with
@@ -36,210 +73,406 @@ class TokenAccountingV2(Utils):
         token_accounts) will be reset.
         """
         self.db: dict[Collections, Collection]
-        self.mqtt: mqtt.Client
+        self.mqtt: paho_mqtt.Client
         # try:
         while self.sending:
-            await asyncio.sleep(0.3)
+            time.sleep(0.3)
             print("waiting for sending to finish")
-        # Read token_accounting_last_processed_block
-        result = self.db[Collections.helpers].find_one(
-            {"_id": "token_accounting_last_processed_block_v3"}
+        token_accounting_last_processed_block, last_event_key = (
+            self.read_token_accounting_checkpoint(
+                "token_accounting_last_processed_block_v3"
+            )
         )
-        # If it's not set, set to -1, which leads to resetting
-        # all token addresses and accounts, basically starting
-        # over with token accounting.
-        if result:
-            token_accounting_last_processed_block = result["height"]
-        else:
-            token_accounting_last_processed_block = -1
+        if token_accounting_last_processed_block == -1:
+            # Starting over, so previously applied events need to be applied again.
+            self.reset_last_event_keys_v2()
+            last_event_key = None
 
-        # Query the logged events collection for all logged events
-        # after 'token_accounting_last_processed_block'.
-        # Logged events are ordered by block_height, then by
-        # transaction index (tx_index) and finally by event index
-        # (ordering).
-        pipeline = [
-            {"$match": {"event_info.standard": "CIS-2"}},
+        result, from_secondary = self.fetch_logged_events_v2(
+            checkpoint_cursor(token_accounting_last_processed_block, last_event_key),
+            self.batch_size,
+        )
+
+        # Only continue if there are logged events to process...
+        if len(result) > 0:
+            (
+                token_accounting_last_processed_block_when_done,
+                last_event_key_when_done,
+            ) = self.checkpoint_after_batch_v2(result, self.batch_size, from_secondary)
+            console.log(
+                f"Token accounting: Starting at {(token_accounting_last_processed_block):,.0f}, I found {len(result):,.0f} logged events on {self.net} to process."
+            )
+            self.process_logged_events_v2(result)
+
+            self.log_last_token_accounted_message_in_mongo(
+                token_accounting_last_processed_block_when_done,
+                last_event_key_when_done,
+            )
+
+    def apply_logged_events_v2(
+        self, batch: TokenAccountingBatchV2, result: list[MongoTypeLoggedEventV2]
+    ) -> int:
+        """
+        Applies logged events to the batch in memory, without reading from
+        or writing to MongoDB. Returns the number of skipped events, that
+        were already applied before.
+        """
+        skipped = 0
+        for log in result:
+            log: MongoTypeLoggedEventV2
+            token_address_id = interned.intern(log.event_info.token_address)
+            key = event_key(log)
+            if self.applied_events.is_applied(token_address_id, key):
+                skipped += 1
+                continue
+            batch.last_event_keys[token_address_id] = key
+
+            if (token_address_id not in batch.token_addresses_initial) and (
+                token_address_id not in batch.token_addresses_to_update
+            ):
+                batch.token_addresses_to_update[token_address_id] = (
+                    self.create_new_token_address_v2(
+                        log.event_info.token_address, log.tx_info.block_height
+                    )
+                )
+
+            # The query only returns tags we have a handler for.
+            self.event_handlers_v2[log.recognized_event.tag](
+                self, batch, token_address_id, log
+            )
+        return skipped
+
+    def checkpoint_after_batch_v2(
+        self,
+        result: list[MongoTypeLoggedEventV2],
+        limit: int,
+        from_secondary: bool,
+    ) -> tuple[int, EventKey | None]:
+        """
+        When all logged events are processed, the checkpoint is set to the
+        (height, last_event_key) returned here, such that next iteration,
+        we will not be re-processing logged events we already have
+        processed, nor skip any we haven't read yet.
+        """
+        last_key = event_key(result[-1])
+        if from_secondary:
+            # A secondary may not have replicated the last block fully,
+            # so we continue from its start. The events from it we did
+            # apply are skipped next time as already applied.
+            return last_key[0] - 1, None
+        if len(result) == limit:
+            # The last block may have more events than we retrieved,
+            # continue right after the last one we read.
+            return last_key[0] - 1, last_key
+        return last_key[0], None
+
+    def process_logged_events_v2(self, result: list[MongoTypeLoggedEventV2]):
+        """
+        Applies a batch of logged events and writes the resulting links
+        and token addresses. Updating the checkpoint is left to the caller.
+        """
+        # Set 'token_addresses_in_batch' contains the interned
+        # token_address ids of this batch. Strings are only formatted
+        # again at the write boundary.
+        token_addresses_in_batch = {
+            interned.intern(log.event_info.token_address) for log in result
+        }
+
+        # Retrieve the token_addresses for all from the collection,
+        # including the key of the last event applied to them.
+        token_addresses_as_class_initial = {}
+        for x in self.consistent_collection(Collections.tokens_token_addresses_v2).find(
             {
-                "$match": {
-                    "tx_info.block_height": {
-                        "$gt": token_accounting_last_processed_block
-                    }
+                "_id": {
+                    "$in": [
+                        interned.lookup(token_address_id)
+                        for token_address_id in token_addresses_in_batch
+                    ]
                 }
-            },
+            }
+        ):
+            token_address_id = interned.intern(x["_id"])
+            self.applied_events.load(token_address_id, x.get("last_event_key"))
+            token_addresses_as_class_initial[token_address_id] = MongoTypeTokenAddress(
+                **x
+            )
+
+        batch = TokenAccountingBatchV2(token_addresses_as_class_initial)
+        skipped = self.apply_logged_events_v2(batch, result)
+
+        links_to_save = [
+            self.link_replacement_v2(token_address_id, account_id)
+            for token_address_id, account_id in batch.links_to_update
+        ]
+        if skipped > 0:
+            console.log(
+                f"Token accounting: skipped {skipped:,.0f} already applied logged events on {self.net}."
+            )
+
+        token_addresses_to_save = []
+        fetch_requests = {}
+        for token_address_id, ta in batch.token_addresses_to_update.items():
+            ta: MongoTypeTokenAddress
+            repl_dict = ta.model_dump(exclude_none=True)
+            if "id" in repl_dict:
+                del repl_dict["id"]
+            # Failed metadata fetch attempts are not carried over.
+            if "failed_attempt" in repl_dict:
+                del repl_dict["failed_attempt"]
+            fetch_requests[token_address_id] = dict(repl_dict)
+
+            # Keep the persisted key as it was before this batch, it's
+            # only moved forward once all writes for the batch are done.
+            applied_key = self.applied_events.get(token_address_id)
+            if applied_key:
+                repl_dict["last_event_key"] = list(applied_key)
+
+            token_addresses_to_save.append(
+                ReplaceOne(
+                    {"_id": ta.id},
+                    replacement=repl_dict,
+                    upsert=True,
+                )
+            )
+        self.publish_metadata_fetch_requests(
+            fetch_requests, batch.token_addresses_initial
+        )
+
+        writes = []
+        if len(links_to_save) > 0:
+            writes.append(
+                (Collections.tokens_links_v3, BatchType.links, links_to_save, "TL")
+            )
+        if len(token_addresses_to_save) > 0:
+            writes.append(
+                (
+                    Collections.tokens_token_addresses_v2,
+                    BatchType.token_addresses,
+                    token_addresses_to_save,
+                    "TA",
+                )
+            )
+        self.bulk_write_v2(writes)
+        self.save_last_event_keys_v2(batch.last_event_keys)
+
+    def fetch_logged_events_v2(
+        self, after_key: EventKey, limit: int, contracts: list[str] | None = None
+    ) -> tuple[list[MongoTypeLoggedEventV2], bool]:
+        """
+        Query the logged events collection for accounting events with an
+        event key after 'after_key', optionally only for the given
+        contracts. Only transfer, mint, burn and metadata events are
+        returned, operator updates and other tags are filtered out by
+        MongoDB, so we never pay for deserializing them.
+        Logged events are ordered by block_height, then by
+        transaction index (tx_index) and finally by effect and event index,
+        which is the event key used to detect already applied events.
+        Returns the events and whether they were read from a secondary.
+        """
+        from_secondary = self.reads_events_from_secondary()
+        result = self.aggregate_logged_events_v2(
+            after_key, limit, contracts, from_secondary
+        )
+        if (
+            from_secondary
+            and len(result) > 0
+            and result[0].tx_info.block_height == result[-1].tx_info.block_height
+        ):
+            # A single, possibly partly replicated, block would leave the
+            # checkpoint where it is. Read it from the primary instead.
+            from_secondary = False
+            result = self.aggregate_logged_events_v2(
+                after_key, limit, contracts, from_secondary
+            )
+        return result, from_secondary
+
+    def aggregate_logged_events_v2(
+        self,
+        after_key: EventKey,
+        limit: int,
+        contracts: list[str] | None,
+        from_secondary: bool,
+    ) -> list[MongoTypeLoggedEventV2]:
+        match = {
+            "event_info.standard": "CIS-2",
+            "recognized_event.tag": {"$in": ACCOUNTING_EVENT_TAGS},
+            **after_event_key_match(after_key),
+        }
+        if contracts is not None:
+            match["event_info.contract"] = {"$in": contracts}
+        pipeline = [
+            {"$match": match},
             {
                 "$sort": {
                     "tx_info.block_height": ASCENDING,
+                    "tx_info.tx_index": ASCENDING,
+                    "event_info.effect_index": ASCENDING,
+                    "event_info.event_index": ASCENDING,
                 }
             },
-            {"$limit": 1_000},
+            {"$limit": limit},
         ]
-        result: list[MongoTypeLoggedEventV2] = [
+        return [
             MongoTypeLoggedEventV2(**x)
-            for x in self.db[Collections.tokens_logged_events_v2].aggregate(pipeline)
+            for x in self.events_collection(from_secondary).aggregate(pipeline)
         ]
 
-        # Only continue if there are logged events to process...
-        token_addresses_to_update = {}
-        if len(result) > 0:
-            # When all logged events are processed,
-            # 'token_accounting_last_processed_block' is set to
-            # 'token_accounting_last_processed_block_when_done'
-            # such that next iteration, we will not be re-processing
-            # logged events we already have processed.
-            token_accounting_last_processed_block_when_done = max(
-                [x.tx_info.block_height for x in result]
-            )
+    def ensure_indexes_v2(self):
+        """
+        Supports the queries in `fetch_logged_events_v2`, with and without
+        a contracts filter.
+        """
+        self.db[Collections.tokens_logged_events_v2].create_index(
+            [
+                ("event_info.standard", ASCENDING),
+                ("recognized_event.tag", ASCENDING),
+                ("tx_info.block_height", ASCENDING),
+                ("tx_info.tx_index", ASCENDING),
+                ("event_info.effect_index", ASCENDING),
+                ("event_info.event_index", ASCENDING),
+            ],
+            name="token_accounting_v2",
+        )
+        self.db[Collections.tokens_logged_events_v2].create_index(
+            [
+                ("event_info.contract", ASCENDING),
+                ("tx_info.block_height", ASCENDING),
+                ("tx_info.tx_index", ASCENDING),
+                ("event_info.effect_index", ASCENDING),
+                ("event_info.event_index", ASCENDING),
+            ],
+            name="token_accounting_v2_contract",
+        )
 
-            # Dict 'events_by_token_address' is keyed on token_address
-            # and contains an ordered list of logged events related to
-            # this token_address.
-            events_by_token_address: dict[str, list] = {}
-            for log in result:
-                events_by_token_address[log.event_info.token_address] = (
-                    events_by_token_address.get(log.event_info.token_address, [])
-                )
-                events_by_token_address[log.event_info.token_address].append(log)
+    def handle_transfer_v2(
+        self, batch: TokenAccountingBatchV2, token_address_id: int, log
+    ):
+        event = log.recognized_event
+        if event.from_address:
+            batch.links_to_update.add(
+                (token_address_id, interned.intern(event.from_address))
+            )
+        if event.to_address:
+            batch.links_to_update.add(
+                (token_address_id, interned.intern(event.to_address))
+            )
 
-            console.log(
-                f"Token accounting: Starting at {(token_accounting_last_processed_block):,.0f}, I found {len(result):,.0f} logged events on {self.net} to process from {len(list(events_by_token_address.keys())):,.0f} token addresses."
+    def handle_mint_v2(self, batch: TokenAccountingBatchV2, token_address_id: int, log):
+        if log.recognized_event.to_address:
+            batch.links_to_update.add(
+                (token_address_id, interned.intern(log.recognized_event.to_address))
             )
 
-            # Retrieve the token_addresses for all from the collection
-            token_addresses_as_class_initial = {
-                x["_id"]: MongoTypeTokenAddress(**x)
-                for x in self.db[Collections.tokens_token_addresses_v2].find(
-                    {"_id": {"$in": list(events_by_token_address.keys())}}
-                )
-            }
+    def handle_burn_v2(self, batch: TokenAccountingBatchV2, token_address_id: int, log):
+        if log.recognized_event.from_address:
+            batch.links_to_update.add(
+                (token_address_id, interned.intern(log.recognized_event.from_address))
+            )
 
-            links_to_save = []
+    def handle_metadata_v2(
+        self, batch: TokenAccountingBatchV2, token_address_id: int, log
+    ):
+        # A new token address was already created by an earlier event.
+        token_address_as_class = batch.token_addresses_to_update.get(
+            token_address_id, batch.token_addresses_initial.get(token_address_id)
+        )
+        token_address_as_class.metadata_url = log.recognized_event.metadata.url
+        batch.token_addresses_to_update[token_address_id] = token_address_as_class
 
-            token_addresses_to_save = []
-            for log in result:
-                log: MongoTypeLoggedEventV2
-                if log.event_info.token_address not in token_addresses_as_class_initial:
-                    token_address_as_class = self.create_new_token_address_v2(
-                        log.event_info.token_address, log.tx_info.block_height
-                    )
-                    token_addresses_to_update[log.event_info.token_address] = (
-                        token_address_as_class
-                    )
+    event_handlers_v2 = {
+        255: handle_transfer_v2,
+        254: handle_mint_v2,
+        253: handle_burn_v2,
+        251: handle_metadata_v2,
+    }
 
-                contract_ = log.event_info.contract
-
-                if log.recognized_event.tag == 252:
-                    # this is an operatorUpdate event, doesn't have a token_id, nothing to do here.
-                    continue
-
-                token_id_ = log.recognized_event.token_id
-                addresses_to_save = []
-                if log.recognized_event.tag == 255:
-                    addresses_to_save.append(log.recognized_event.from_address)
-                    addresses_to_save.append(log.recognized_event.to_address)
-                elif log.recognized_event.tag == 254:
-                    addresses_to_save.append(log.recognized_event.to_address)
-                elif log.recognized_event.tag == 253:
-                    addresses_to_save.append(log.recognized_event.from_address)
-                elif log.recognized_event.tag == 251:
-                    if (
-                        log.event_info.token_address
-                        not in token_addresses_as_class_initial
-                    ):
-                        token_address_as_class = self.create_new_token_address_v2(
-                            log.event_info.token_address, log.tx_info.block_height
-                        )
-                        token_addresses_to_update[log.event_info.token_address] = (
-                            token_address_as_class
-                        )
-
-                    else:
-                        token_address_as_class = token_addresses_as_class_initial[
-                            log.event_info.token_address
-                        ]
-
-                    token_address_as_class.metadata_url = (
-                        log.recognized_event.metadata.url
-                    )
-                    token_addresses_to_update[log.event_info.token_address] = (
-                        token_address_as_class
-                    )
-                    # save_token_address = True
-
-                for address in list(set(addresses_to_save)):
-                    if address is None:
-                        continue
-
-                    _id = f"{contract_}-{token_id_}-{address}"
-                    token_holding = MongoTypeTokenForAddress(
-                        **{
-                            "token_address": f"{contract_}-{token_id_}",
-                            "contract": contract_,
-                            "token_id": token_id_,
-                            "token_amount": 0,
-                        }
+    def bulk_write_v2(self, writes: list[tuple[Collections, BatchType, list, str]]):
+        """
+        Sends the bulk writes for a batch. In catch-up mode, the writes to the
+        different collections are independent, so they run in parallel.
+        """
+        if self.mode == SchedulingMode.catch_up and len(writes) > 1:
+            with ThreadPoolExecutor(max_workers=len(writes)) as executor:
+                futures = [
+                    executor.submit(
+                        self.write_collection(collection, batch_type).bulk_write,
+                        queue,
                     )
+                    for collection, batch_type, queue, _ in writes
+                ]
+                results = [future.result() for future in futures]
+        else:
+            results = [
+                self.write_collection(collection, batch_type).bulk_write(queue)
+                for collection, batch_type, queue, _ in writes
+            ]
+        for (_, _, queue, label), result in zip(writes, results):
+            console.log(
+                f"{label} {self.net}:  {len(queue):5,.0f} | M {result.matched_count:5,.0f} | Mod {result.modified_count:5,.0f} | U {result.upserted_count:5,.0f}"
+            )
 
-                    link_to_save = MongoTypeTokenLink(
-                        **{
-                            "_id": _id,
-                            "account_address": address,
-                            "account_address_canonical": address[:29],
-                        }
-                    )
-                    link_to_save.token_holding = token_holding
-                    repl_dict = link_to_save.model_dump(exclude_none=True)
-                    if "id" in repl_dict:
-                        del repl_dict["id"]
-                    links_to_save.append(
-                        ReplaceOne({"_id": _id}, repl_dict, upsert=True)
-                    )
+    def reset_last_event_keys_v2(self):
+        self.applied_events = AppliedEventIndex()
+        self.db[Collections.tokens_token_addresses_v2].update_many(
+            {"last_event_key": {"$exists": True}},
+            {"$unset": {"last_event_key": ""}},
+        )
 
-            for ta in token_addresses_to_update.values():
-                ta: MongoTypeTokenAddress
-                repl_dict = ta.model_dump(exclude_none=True)
-                if "id" in repl_dict:
-                    del repl_dict["id"]
-
-                token_addresses_to_save.append(
-                    ReplaceOne(
-                        {"_id": ta.id},
-                        replacement=repl_dict,
-                        upsert=True,
-                    )
-                )
-                if "failed_attempt" in repl_dict:
-                    del repl_dict["failed_attempt"]
-                self.mqtt.publish(
-                    f"ccdexplorer/{self.net}/metadata/fetch",
-                    json.dumps(repl_dict),
-                    qos=MQTT_QOS,
+    def save_last_event_keys_v2(self, last_event_keys: dict[int, EventKey]):
+        """
+        Records the last applied event key per token address. This is done
+        after all other writes for the batch, so a batch that is retried
+        after a partial write re-applies everything that may be missing.
+        """
+        if len(last_event_keys) == 0:
+            return
+        self.write_collection(
+            Collections.tokens_token_addresses_v2, BatchType.token_addresses
+        ).bulk_write(
+            [
+                UpdateOne(
+                    {"_id": interned.lookup(token_address_id)},
+                    {"$set": {"last_event_key": list(key)}},
                 )
+                for token_address_id, key in last_event_keys.items()
+            ]
+        )
+        for token_address_id, key in last_event_keys.items():
+            self.applied_events.update(token_address_id, key)
 
-            if len(links_to_save) > 0:
-                result2 = self.db[Collections.tokens_links_v3].bulk_write(links_to_save)
-                console.log(
-                    f"TL:  {len(links_to_save):5,.0f} | M {result2.matched_count:5,.0f} | Mod {result2.modified_count:5,.0f} | U {result2.upserted_count:5,.0f}"
-                )
-                # if result2.upserted_count > 0:
-                #     console.log(result2.upserted_ids)
-            if len(token_addresses_to_save) > 0:
-                result3 = self.db[Collections.tokens_token_addresses_v2].bulk_write(
-                    token_addresses_to_save
-                )
-                console.log(
-                    f"TA:  {len(token_addresses_to_save):5,.0f} | M {result3.matched_count:5,.0f} | Mod {result3.modified_count:5,.0f} | U {result3.upserted_count:5,.0f}"
-                )
+    def link_replacement_v2(self, token_address_id: int, account_id: int) -> ReplaceOne:
+        """
+        Formats the link document for an interned (token_address, account) pair.
+        """
+        token_address, contract, token_id = token_address_parts(token_address_id)
+        account_address, account_address_canonical = account_address_parts(account_id)
+        _id = link_id(token_address_id, account_id)
+        token_holding = MongoTypeTokenForAddress(
+            **{
+                "token_address": token_address,
+                "contract": contract,
+                "token_id": token_id,
+                "token_amount": 0,
+            }
+        )
 
-            self.log_last_token_accounted_message_in_mongo(
-                token_accounting_last_processed_block_when_done
-            )
+        link_to_save = MongoTypeTokenLink(
+            **{
+                "_id": _id,
+                "account_address": account_address,
+                "account_address_canonical": account_address_canonical,
+            }
+        )
+        link_to_save.token_holding = token_holding
+        repl_dict = link_to_save.model_dump(exclude_none=True)
+        if "id" in repl_dict:
+            del repl_dict["id"]
+        return ReplaceOne({"_id": _id}, repl_dict, upsert=True)
 
     def create_new_token_address_v2(
         self, token_address: str, height: int
     ) -> MongoTypeTokenAddressV2:
-        instance_address = token_address.split("-")[0]
-        token_id = token_address.split("-")[1]
+        instance_address, token_id = split_token_address(token_address)
         token_address = MongoTypeTokenAddressV2(
             **{
                 "_id": token_address,
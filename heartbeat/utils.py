@@ -1,8 +1,17 @@
+from __future__ import annotations
+
 from enum import Enum
+from typing import TYPE_CHECKING
 
-from ccdexplorer_fundamentals.GRPCClient.CCD_Types import CCD_BlockInfo
 from ccdexplorer_fundamentals.mongodb import Collections
 
+from .routing import BatchType, MongoRouting
+
+if TYPE_CHECKING:
+    from ccdexplorer_fundamentals.GRPCClient.CCD_Types import CCD_BlockInfo
+
+    from .idempotency import EventKey
+
 
 class Queue(Enum):
     """
@@ -17,19 +26,59 @@ class Queue(Enum):
     token_links = 15
 
 
-class Utils:
+class SchedulingMode(Enum):
+    """
+    catch_up: far behind the latest logged event, large batches, no sleep.
+    tail: close to the latest logged event, small batches, low latency.
+    """
 
-    def log_last_token_accounted_message_in_mongo(self, height: int):
-        query = {"_id": "token_accounting_last_processed_block_v3"}
-        self.db[Collections.helpers].replace_one(
-            query,
-            {
-                "_id": "token_accounting_last_processed_block_v3",
-                "height": height,
-            },
+    catch_up = "catch_up"
+    tail = "tail"
+
+
+class Utils(MongoRouting):
+    def read_token_accounting_checkpoint(self, _id: str) -> tuple[int, list | None]:
+        """
+        Returns the height and, if a batch ended inside the next block,
+        the key of the last event read from it. See `checkpoint_cursor`.
+        """
+        result = self.consistent_collection(Collections.helpers).find_one({"_id": _id})
+        # If it's not set, set to -1, which leads to resetting
+        # all token addresses and accounts, basically starting
+        # over with token accounting.
+        if result:
+            return result["height"], result.get("last_event_key")
+        else:
+            return -1, None
+
+    def log_token_accounting_checkpoint(
+        self, _id: str, height: int, last_event_key: EventKey | None = None
+    ):
+        checkpoint = {
+            "_id": _id,
+            "height": height,
+        }
+        if last_event_key is not None:
+            checkpoint["last_event_key"] = list(last_event_key)
+        self.write_collection(Collections.helpers, BatchType.checkpoints).replace_one(
+            {"_id": _id},
+            checkpoint,
             upsert=True,
         )
 
+    def read_last_token_accounted_height(self) -> int:
+        height, _ = self.read_token_accounting_checkpoint(
+            "token_accounting_last_processed_block_v3"
+        )
+        return height
+
+    def log_last_token_accounted_message_in_mongo(
+        self, height: int, last_event_key: EventKey | None = None
+    ):
+        self.log_token_accounting_checkpoint(
+            "token_accounting_last_processed_block_v3", height, last_event_key
+        )
+
     def log_error_in_mongo(self, e, current_block_to_process: CCD_BlockInfo):
         query = {"_id": f"block_failure_{current_block_to_process.height}"}
         self.db[Collections.helpers].replace_one(
@@ -1,71 +1,71 @@
-import atexit
 import asyncio
-import urllib3
-from ccdexplorer_fundamentals.GRPCClient import GRPCClient
-from ccdexplorer_fundamentals.mongodb import (
-    MongoDB,
-    MongoMotor,
-)
-from ccdexplorer_fundamentals.tooter import Tooter
+
 from rich.console import Console
-from scheduler.asyncio import Scheduler
-from env import RUN_ON_NET, MQTT_PASSWORD, MQTT_QOS, MQTT_SERVER, MQTT_USER
-from heartbeat import Heartbeat
-import datetime as dt
-import paho.mqtt.client as mqtt
 
-urllib3.disable_warnings()
+from env import ERROR_BACKOFF_MAX_SECONDS, RUN_ON_NET, RUN_ON_NETS
+from heartbeat import Heartbeat, Services
 
 console = Console()
-grpcclient = GRPCClient()
-tooter = Tooter()
-
-mongodb = MongoDB(tooter)
-motormongo = MongoMotor(tooter)
-
 
-# The callback for when the client receives a CONNACK response from the server.
-def on_connect(client, userdata, flags, reason_code, properties):
-    console.log(f"MQTT connected with result code: {reason_code}")
+NETS = ["mainnet", "testnet"]
 
 
-def on_subscribe(client, userdata, mid, reason_code_list, properties):
-    if reason_code_list[0].is_failure:
-        console.log(f"Broker rejected you subscription: {reason_code_list[0]}")
-    else:
-        console.log(f"Broker granted the following QoS: {reason_code_list[0].value}")
+async def ensure_indexes(heartbeat: Heartbeat):
+    """
+    One-off startup step, before any accounting loop runs. Building an
+    index on the logged events collection can take long, so it is done
+    here and not inside a cycle. If it fails, the loops still run, only
+    slower, and the indexes are retried on the next start.
+    """
+    try:
+        await asyncio.to_thread(heartbeat.ensure_indexes_v2)
+    except Exception as e:
+        console.log(f"Ensuring indexes on {heartbeat.net} failed: {e}")
 
 
-mqttc = mqtt.Client(
-    mqtt.CallbackAPIVersion.VERSION2,
-    f"mqtt-{RUN_ON_NET}-token-accounting",
-)
-
-mqttc.on_connect = on_connect
-mqttc.on_subscribe = on_subscribe
-
-mqttc.username_pw_set(MQTT_USER, MQTT_PASSWORD)
-mqttc.connect(MQTT_SERVER, 1883, 10)
-mqttc.subscribe("ccdexplorer/services/accounting/restart", qos=MQTT_QOS)
-mqttc.loop_start()
+async def run_net(heartbeat: Heartbeat):
+    """
+    Keeps the accounting loop for one net running. If it fails, it is
+    restarted after a pause, while the loops for other nets carry on.
+    """
+    while True:
+        try:
+            await heartbeat.run_token_accounting()
+        except Exception as e:
+            console.log(
+                f"Token accounting loop on {heartbeat.net} stopped, restarting in {ERROR_BACKOFF_MAX_SECONDS:,.0f}s: {e}"
+            )
+            await asyncio.sleep(ERROR_BACKOFF_MAX_SECONDS)
 
 
 async def main():
-    """ """
-    console.log(f"{RUN_ON_NET=}")
-    loop = asyncio.get_running_loop()
-    schedule = Scheduler(loop=loop)
-    # schedule = Scheduler()
-
-    heartbeat = Heartbeat(grpcclient, tooter, mongodb, motormongo, mqttc, RUN_ON_NET)
-    atexit.register(heartbeat.exit)
-
-    # loop = asyncio.get_event_loop()
-
-    schedule.cyclic(dt.timedelta(seconds=1), heartbeat.update_token_accounting_v2)
-
-    while True:
-        await asyncio.sleep(1)
+    """
+    Dependencies are created lazily by Services, so startup only waits
+    for what the accounting loop actually uses.
+    With multiple nets in RUN_ON_NET, one process runs an independent
+    accounting loop per net. They share the connections, checkpoints and
+    scheduling state are kept per net. Each cycle runs in a worker
+    thread, so a net waiting on MongoDB doesn't hold up the others.
+    """
+    console.log(f"{RUN_ON_NETS=}")
+    if len(RUN_ON_NETS) == 0 or any(net not in NETS for net in RUN_ON_NETS):
+        raise SystemExit(
+            f"RUN_ON_NET must be one or more of {', '.join(NETS)}, comma separated, got {RUN_ON_NET!r}."
+        )
+    services = Services(f"mqtt-{'-'.join(RUN_ON_NETS)}-token-accounting")
+    # connects in the background, doesn't block the first cycle.
+    services.mqtt
+    # Cycles run in worker threads, create the MongoDB clients they share
+    # once here, not concurrently from each thread.
+    services.mongodb
+    services.events_client
+
+    heartbeats = [Heartbeat(services, net) for net in RUN_ON_NETS]
+    try:
+        await asyncio.gather(*[ensure_indexes(heartbeat) for heartbeat in heartbeats])
+        await asyncio.gather(*[run_net(heartbeat) for heartbeat in heartbeats])
+    finally:
+        await services.close()
 
 
 if __name__ == "__main__":
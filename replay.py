@@ -0,0 +1,243 @@
+"""
+Replay logged events through the legacy (v1) and the current (v2) token
+accounting engines in memory and compare the results.
+
+Events come from `tokens_logged_events_v2` for a height range, or from
+an exported file (mongoexport JSON lines or a JSON array), so this also
+runs offline against a dump. Work is split over contract partitions and
+run in parallel.
+
+The two engines keep different layouts. v1 keeps balances and supply per
+token address, v2 only keeps the set of accounts that were ever linked
+to a token address, plus metadata. We check that:
+- every account with a non-zero v1 balance has a v2 link,
+- the v1 supply equals the sum of v1 balances,
+- the batch v1 engine matches the sequential v1 engine,
+- both engines end with the same metadata url.
+Both engines start from empty token addresses, so a range that doesn't
+start at the first event of a contract will report mismatches for it.
+
+Usage:
+    python replay.py --net mainnet --from-height 5000000 --to-height 5100000
+    python replay.py --file tokens_logged_events_v2.json --workers 8
+"""
+
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from bson import json_util
+from rich.console import Console
+
+console = Console()
+
+
+def load_events_from_mongo(net: str, from_height: int, to_height: int) -> list[dict]:
+    from ccdexplorer_fundamentals.mongodb import Collections
+    from pymongo import ASCENDING
+
+    from heartbeat import Services
+    from heartbeat.token_accounting_v2 import ACCOUNTING_EVENT_TAGS
+
+    services = Services("")
+    db = services.mongodb.mainnet if net == "mainnet" else services.mongodb.testnet
+    return list(
+        db[Collections.tokens_logged_events_v2]
+        .find(
+            {
+                "event_info.standard": "CIS-2",
+                "recognized_event.tag": {"$in": ACCOUNTING_EVENT_TAGS},
+                "tx_info.block_height": {"$gte": from_height, "$lte": to_height},
+            }
+        )
+        .sort(
+            [
+                ("tx_info.block_height", ASCENDING),
+                ("tx_info.tx_index", ASCENDING),
+                ("event_info.effect_index", ASCENDING),
+                ("event_info.event_index", ASCENDING),
+            ]
+        )
+    )
+
+
+def load_events_from_file(path: str, from_height: int, to_height: int) -> list[dict]:
+    from heartbeat.token_accounting_v2 import ACCOUNTING_EVENT_TAGS
+
+    with open(path) as f:
+        content = f.read().strip()
+    if content.startswith("["):
+        docs = json_util.loads(content)
+    else:
+        docs = [json_util.loads(line) for line in content.splitlines() if line]
+
+    docs = [
+        x
+        for x in docs
+        if x["event_info"].get("standard") == "CIS-2"
+        and x["recognized_event"]["tag"] in ACCOUNTING_EVENT_TAGS
+        and from_height <= x["tx_info"]["block_height"] <= to_height
+    ]
+    docs.sort(
+        key=lambda x: (
+            x["tx_info"]["block_height"],
+            x["tx_info"]["tx_index"],
+            x["event_info"]["effect_index"],
+            x["event_info"]["event_index"],
+        )
+    )
+    return docs
+
+
+def partition_by_contract(docs: list[dict], partitions: int) -> list[list[dict]]:
+    """
+    Contracts never share token addresses, so each contract can be replayed
+    on its own. Contracts are spread over partitions by event count, keeping
+    the order of events within a contract.
+    """
+    by_contract: dict[str, list[dict]] = {}
+    for doc in docs:
+        by_contract.setdefault(doc["event_info"]["contract"], []).append(doc)
+
+    result: list[list[dict]] = [[] for _ in range(partitions)]
+    for events in sorted(by_contract.values(), key=len, reverse=True):
+        min(result, key=len).extend(events)
+    return [x for x in result if x]
+
+
+def replay_partition(docs: list[dict]) -> dict:
+    from ccdexplorer_fundamentals.cis import MongoTypeLoggedEventV2
+
+    from heartbeat.idempotency import AppliedEventIndex
+    from heartbeat.interning import interned
+    from heartbeat.token_accounting import TokenAccounting
+    from heartbeat.token_accounting_v2 import (
+        TokenAccountingBatchV2,
+        TokenAccountingV2,
+    )
+
+    logs = [MongoTypeLoggedEventV2(**x) for x in docs]
+    events_by_token_address: dict[str, list] = {}
+    for log in logs:
+        events_by_token_address.setdefault(log.event_info.token_address, []).append(log)
+
+    # v1, sequential
+    v1 = TokenAccounting()
+    start = time.perf_counter()
+    v1_sequential = {}
+    for token_address, token_address_logs in events_by_token_address.items():
+        token_address_as_class = v1.create_new_token_address(token_address)
+        for log in token_address_logs:
+            token_address_as_class = v1.execute_logged_event(
+                token_address_as_class, log
+            )
+        v1_sequential[token_address] = token_address_as_class
+    v1_seconds = time.perf_counter() - start
+
+    # v1, batch
+    start = time.perf_counter()
+    v1_batch = {
+        token_address: v1.create_new_token_address(token_address)
+        for token_address in events_by_token_address
+    }
+    v1.execute_logged_events_batch(v1_batch, logs)
+    v1_batch_seconds = time.perf_counter() - start
+
+    # v2
+    v2 = TokenAccountingV2()
+    v2.applied_events = AppliedEventIndex()
+    start = time.perf_counter()
+    batch = TokenAccountingBatchV2({})
+    v2.apply_logged_events_v2(batch, logs)
+    v2_seconds = time.perf_counter() - start
+
+    v2_accounts: dict[str, set] = {}
+    for token_address_id, account_id in batch.links_to_update:
+        v2_accounts.setdefault(interned.lookup(token_address_id), set()).add(
+            interned.lookup(account_id)
+        )
+    v2_metadata = {
+        interned.lookup(token_address_id): x.metadata_url
+        for token_address_id, x in batch.token_addresses_to_update.items()
+    }
+
+    mismatches = []
+    for token_address, sequential in v1_sequential.items():
+        holders = {k: int(v) for k, v in sequential.token_holders.items()}
+        supply = int(sequential.token_amount)
+        missing = {k for k, v in holders.items() if v != 0} - v2_accounts.get(
+            token_address, set()
+        )
+        if missing:
+            mismatches.append(
+                f"{token_address}: {len(missing)} v1 holders without a v2 link"
+            )
+        if supply != sum(holders.values()):
+            mismatches.append(
+                f"{token_address}: v1 supply {supply} != sum of balances {sum(holders.values())}"
+            )
+        batched = v1_batch[token_address]
+        if (batched.token_holders != sequential.token_holders) or (
+            batched.token_amount != sequential.token_amount
+        ):
+            mismatches.append(f"{token_address}: v1 batch != v1 sequential")
+        if sequential.metadata_url != v2_metadata.get(token_address):
+            mismatches.append(f"{token_address}: metadata url differs")
+
+    return {
+        "events": len(logs),
+        "token_addresses": len(events_by_token_address),
+        "v1_seconds": v1_seconds,
+        "v1_batch_seconds": v1_batch_seconds,
+        "v2_seconds": v2_seconds,
+        "mismatches": mismatches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay logged events through v1 and v2 token accounting and compare."
+    )
+    parser.add_argument("--net", default="mainnet", choices=["mainnet", "testnet"])
+    parser.add_argument("--file", help="exported tokens_logged_events_v2 file")
+    parser.add_argument("--from-height", type=int, default=0)
+    parser.add_argument("--to-height", type=int, default=2**63 - 1)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--show", type=int, default=20, help="mismatches to print")
+    args = parser.parse_args()
+
+    if args.file:
+        docs = load_events_from_file(args.file, args.from_height, args.to_height)
+    else:
+        docs = load_events_from_mongo(args.net, args.from_height, args.to_height)
+    console.log(f"Replaying {len(docs):,.0f} logged events.")
+    if len(docs) == 0:
+        return
+
+    partitions = partition_by_contract(docs, args.workers)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(replay_partition, partitions))
+    wall_seconds = time.perf_counter() - start
+
+    events = sum(x["events"] for x in results)
+    mismatches = [m for x in results for m in x["mismatches"]]
+    console.log(
+        f"{events:,.0f} events on {sum(x['token_addresses'] for x in results):,.0f} token addresses in {len(partitions)} partitions, {wall_seconds:,.2f}s wall time."
+    )
+    for label, key in [
+        ("v1 sequential", "v1_seconds"),
+        ("v1 batch", "v1_batch_seconds"),
+        ("v2", "v2_seconds"),
+    ]:
+        seconds = sum(x[key] for x in results)
+        console.log(
+            f"{label:>14}: {seconds:8,.3f}s CPU, {(events / seconds if seconds else 0):12,.0f} events/s"
+        )
+    console.log(f"{len(mismatches):,.0f} mismatches.")
+    for mismatch in mismatches[: args.show]:
+        console.log(mismatch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import random
+
+import pytest
+
+from heartbeat.balance_engine import compute_balances
+
+
+def apply_one_by_one(holder_rows, supply_rows, initial_holders, initial_amounts):
+    """
+    Reference: what `execute_logged_event` does, one row at a time with
+    amounts stored as strings.
+    """
+    token_holders = {
+        token_address: {account: str(amount) for account, amount in holders.items()}
+        for token_address, holders in initial_holders.items()
+    }
+    token_amounts = {
+        token_address: str(amount) for token_address, amount in initial_amounts.items()
+    }
+    negative = []
+    for token_address, account_address, delta in holder_rows:
+        holders = token_holders.setdefault(token_address, {})
+        holders[account_address] = str(int(holders.get(account_address, "0")) + delta)
+        if (int(holders[account_address]) < 0) and (
+            (token_address, account_address) not in negative
+        ):
+            negative.append((token_address, account_address))
+    for token_address, delta in supply_rows:
+        token_amounts[token_address] = str(
+            int(token_amounts.get(token_address, "0")) + delta
+        )
+    return token_holders, token_amounts, negative
+
+
+def assert_matches_one_by_one(
+    holder_rows, supply_rows, initial_holders, initial_amounts
+):
+    result = compute_balances(
+        holder_rows, supply_rows, initial_holders, initial_amounts
+    )
+    token_holders, token_amounts, negative = apply_one_by_one(
+        holder_rows, supply_rows, initial_holders, initial_amounts
+    )
+    for token_address, holders in result.token_holders.items():
+        assert {k: str(v) for k, v in holders.items()} == token_holders[token_address]
+    for token_address, amount in result.token_amounts.items():
+        assert str(amount) == token_amounts[token_address]
+    assert result.negative_balances == negative
+    return result
+
+
+def random_rows(seed: int, rows: int, max_amount: int):
+    rng = random.Random(seed)
+    token_addresses = [f"<{9000 + i},0>-" for i in range(5)]
+    accounts = [f"account_{i}" for i in range(20)]
+    holder_rows = [
+        (
+            rng.choice(token_addresses),
+            rng.choice(accounts),
+            rng.randint(-max_amount, max_amount),
+        )
+        for _ in range(rows)
+    ]
+    supply_rows = [
+        (rng.choice(token_addresses), rng.randint(-max_amount, max_amount))
+        for _ in range(rows // 10)
+    ]
+    initial_holders = {
+        token_address: {
+            account: rng.randint(0, max_amount) for account in rng.sample(accounts, 5)
+        }
+        for token_address in token_addresses[:3]
+    }
+    initial_amounts = {
+        token_address: rng.randint(0, max_amount)
+        for token_address in token_addresses[:3]
+    }
+    return holder_rows, supply_rows, initial_holders, initial_amounts
+
+
+@pytest.mark.parametrize("max_amount", [10**6, 2**63, 10**40])
+@pytest.mark.parametrize("seed", range(5))
+def test_batch_matches_one_by_one(seed, max_amount):
+    assert_matches_one_by_one(*random_rows(seed, 1_000, max_amount))
+
+
+def test_negative_intermediate_balance_is_reported():
+    # account_a dips below zero, but ends positive.
+    holder_rows = [
+        ("<1,0>-", "account_a", -5),
+        ("<1,0>-", "account_a", 10),
+        ("<1,0>-", "account_b", 3),
+        ("<2,0>-", "account_a", -2),
+        ("<2,0>-", "account_a", 1),
+    ]
+    initial_holders = {"<1,0>-": {"account_a": 2}, "<2,0>-": {"account_a": 2}}
+    result = assert_matches_one_by_one(holder_rows, [], initial_holders, {})
+
+    assert result.token_holders == {
+        "<1,0>-": {"account_a": 7, "account_b": 3},
+        "<2,0>-": {"account_a": 1},
+    }
+    assert result.negative_balances == [("<1,0>-", "account_a")]
+
+
+def test_amounts_above_int64_stay_exact():
+    big = 2**63 - 1
+    holder_rows = [("<1,0>-", "account_a", big), ("<1,0>-", "account_a", big)]
+    supply_rows = [("<1,0>-", big), ("<1,0>-", big)]
+    result = assert_matches_one_by_one(holder_rows, supply_rows, {}, {"<1,0>-": 1})
+
+    assert result.token_holders["<1,0>-"]["account_a"] == 2 * big
+    assert result.token_amounts["<1,0>-"] == 2 * big + 1
@@ -0,0 +1,162 @@
+from types import SimpleNamespace
+
+import pytest
+
+from heartbeat.idempotency import (
+    AppliedEventIndex,
+    after_event_key_match,
+    checkpoint_cursor,
+    event_key,
+)
+from heartbeat.token_accounting_v2 import TokenAccountingV2
+
+KEY_FIELDS = {
+    "tx_info.block_height": 0,
+    "tx_info.tx_index": 1,
+    "event_info.effect_index": 2,
+    "event_info.event_index": 3,
+}
+
+
+def log_for_key(key):
+    height, tx_index, effect_index, event_index = key
+    return SimpleNamespace(
+        tx_info=SimpleNamespace(block_height=height, tx_index=tx_index),
+        event_info=SimpleNamespace(effect_index=effect_index, event_index=event_index),
+    )
+
+
+def matches(condition: dict, key) -> bool:
+    """
+    Evaluates the filters from `after_event_key_match` on a key.
+    """
+    if "$or" in condition:
+        return any(matches(x, key) for x in condition["$or"])
+    for field, value in condition.items():
+        actual = key[KEY_FIELDS[field]]
+        if isinstance(value, dict):
+            if "$gt" in value and not actual > value["$gt"]:
+                return False
+            if "$gte" in value and not actual >= value["$gte"]:
+                return False
+        elif actual != value:
+            return False
+    return True
+
+
+@pytest.mark.parametrize(
+    "height, last_event_key, cursor",
+    [
+        (-1, None, (0, -1, -1, -1)),
+        (99, None, (100, -1, -1, -1)),
+        (99, [100, 2, 0, 5], (100, 2, 0, 5)),
+        # a key that doesn't belong to the next block is stale
+        (100, [100, 2, 0, 5], (101, -1, -1, -1)),
+        (99, [50, 2, 0, 5], (100, -1, -1, -1)),
+    ],
+)
+def test_checkpoint_cursor(height, last_event_key, cursor):
+    assert checkpoint_cursor(height, last_event_key) == cursor
+
+
+@pytest.mark.parametrize(
+    "after_key, key, expected",
+    [
+        ((100, -1, -1, -1), (99, 9, 9, 9), False),
+        ((100, -1, -1, -1), (100, 0, 0, 0), True),
+        ((100, 2, 0, 5), (100, 2, 0, 5), False),
+        ((100, 2, 0, 5), (100, 2, 0, 4), False),
+        ((100, 2, 0, 5), (100, 2, 0, 6), True),
+        ((100, 2, 0, 5), (100, 2, 1, 0), True),
+        ((100, 2, 0, 5), (100, 1, 9, 9), False),
+        ((100, 2, 0, 5), (100, 3, 0, 0), True),
+        ((100, 2, 0, 5), (101, 0, 0, 0), True),
+    ],
+)
+def test_after_event_key_match(after_key, key, expected):
+    assert matches(after_event_key_match(after_key), key) is expected
+
+
+@pytest.mark.parametrize(
+    "keys, limit, from_secondary, checkpoint",
+    [
+        # not full: everything up to the last block is done
+        ([(5, 0, 0, 0), (7, 0, 0, 1)], 10, False, (7, None)),
+        # full: the last block may continue, keep the key of the last event
+        ([(5, 0, 0, 0), (7, 0, 0, 1)], 2, False, (6, (7, 0, 0, 1))),
+        # full, with a single block
+        ([(7, 0, 0, 0), (7, 0, 0, 1)], 2, False, (6, (7, 0, 0, 1))),
+        # secondary: the last block may be partly replicated
+        ([(5, 0, 0, 0), (7, 0, 0, 1)], 10, True, (6, None)),
+        ([(5, 0, 0, 0), (7, 0, 0, 1)], 2, True, (6, None)),
+    ],
+)
+def test_checkpoint_after_batch(keys, limit, from_secondary, checkpoint):
+    result = [log_for_key(key) for key in keys]
+    assert (
+        TokenAccountingV2().checkpoint_after_batch_v2(result, limit, from_secondary)
+        == checkpoint
+    )
+
+
+@pytest.mark.parametrize("limit", [1, 3, 7, 10, 1000])
+def test_paging_reads_every_event_once(limit):
+    # block 4 has far more events than fit in a batch
+    keys = sorted(
+        {
+            (height, tx, 0, event)
+            for height in [1, 2, 4, 6]
+            for tx in range(3)
+            for event in range(3)
+        }
+        | {
+            (4, tx, effect, event)
+            for tx in range(5)
+            for effect in range(4)
+            for event in range(5)
+        }
+    )
+    height, last_event_key = -1, None
+    read = []
+    while True:
+        condition = after_event_key_match(checkpoint_cursor(height, last_event_key))
+        batch = [key for key in keys if matches(condition, key)][:limit]
+        if len(batch) == 0:
+            break
+        read.extend(batch)
+        height, last_event_key = TokenAccountingV2().checkpoint_after_batch_v2(
+            [log_for_key(key) for key in batch], limit, False
+        )
+    assert read == keys
+
+
+def test_applied_event_index():
+    index = AppliedEventIndex()
+    assert not index.is_applied(1, (5, 0, 0, 0))
+
+    index.load(1, [5, 1, 0, 0])
+    assert index.is_applied(1, (5, 0, 0, 0))
+    assert index.is_applied(1, (5, 1, 0, 0))
+    assert not index.is_applied(1, (5, 1, 0, 1))
+    assert not index.is_applied(2, (5, 0, 0, 0))
+
+    # a persisted key never moves the in-memory key backwards
+    index.update(1, (6, 0, 0, 0))
+    index.load(1, [5, 1, 0, 0])
+    assert index.get(1) == (6, 0, 0, 0)
+    index.load(1, None)
+    assert index.get(1) == (6, 0, 0, 0)
+
+
+def test_applied_event_index_evicts_least_recently_used():
+    index = AppliedEventIndex(max_size=2)
+    index.update(1, (1, 0, 0, 0))
+    index.update(2, (1, 0, 0, 0))
+    index.update(1, (2, 0, 0, 0))
+    index.update(3, (1, 0, 0, 0))
+    assert index.get(2) is None
+    assert index.get(1) == (2, 0, 0, 0)
+
+
+def test_event_key():
+    assert event_key(log_for_key((10, 1, 2, 3))) == (10, 1, 2, 3)